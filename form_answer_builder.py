@@ -1,9 +1,12 @@
 # form_answer_builder.py
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import re
-from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union, Optional
+import urllib.parse
+from typing import Any, Dict, FrozenSet, Iterator, List, Tuple, Union, Optional
 import requests
+from requests.adapters import HTTPAdapter
+
+from normalization import norm
 
 Answer = Union[str, int, float, List[Union[str, int, float]], Tuple[Union[str, int, float], ...]]
 
@@ -22,14 +25,31 @@ class FormAnswerBuilder:
         self.ua = ua or "Mozilla/5.0"
         self.timeout = timeout
 
+        # одна сессия на билдер: keep-alive между повторными отправками
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self._session.headers["User-Agent"] = self.ua
+
         self.action: str = parsed.get("meta", {}).get("action", "")
         self.fbzx: str = parsed.get("meta", {}).get("fbzx", "")
-        self.q_by_id: Dict[str, Dict[str, Any]] = {}
 
-        for q in parsed.get("questions", []):
+        # индексы строим один раз, ключи entry_id — уже строки
+        self._eid_to_q: Dict[str, Dict[str, Any]] = {}
+        self._index_to_eid: Dict[int, str] = {}
+        self._text_to_eid: Dict[str, str] = {}
+        self._choices_set: Dict[str, FrozenSet[str]] = {}
+        self._field_keys: Dict[str, Tuple[str, str, str]] = {}  # eid -> (entry key, other key, other flag)
+        for i, q in enumerate(parsed.get("questions", []) or []):
             eid = q.get("entry_id")
-            if eid:
-                self.q_by_id[str(eid)] = q
+            if not eid:
+                continue
+            eid = str(eid)
+            self._eid_to_q[eid] = q
+            self._index_to_eid[i] = eid
+            self._text_to_eid.setdefault(norm(q.get("text") or ""), eid)
+            self._choices_set[eid] = frozenset(q.get("choices_or_rows") or ())
+            self._field_keys[eid] = self._make_field_keys(eid, q)
+        self.q_by_id = self._eid_to_q
 
         # ответы пользователя: entry_id -> value
         # value может быть:
@@ -41,14 +61,14 @@ class FormAnswerBuilder:
 
     def set_answer(self, entry_id: str, value: Any) -> None:
         entry_id = str(entry_id)
-        q = self.q_by_id.get(entry_id)
+        q = self._eid_to_q.get(entry_id)
         if not q:
             if self.strict:
                 raise ValueError(f"Неизвестный entry_id: {entry_id}")
             return
 
         qtype = (q.get("type") or "").lower()
-        choices = q.get("choices_or_rows") or []
+        choices_set = self._choices_set[entry_id]
         other_allowed = bool(q.get("other_allowed"))
 
         # если сразу пришёл dict с "__other__" — принимаем без проверок
@@ -60,7 +80,7 @@ class FormAnswerBuilder:
             return
 
         if qtype in ("multiple_choice", "dropdown", "choice"):
-            if isinstance(value, str) and value in choices:
+            if isinstance(value, str) and value in choices_set:
                 self.answers[entry_id] = value
                 return
             if other_allowed and isinstance(value, str):
@@ -74,15 +94,16 @@ class FormAnswerBuilder:
         if qtype == "checkboxes":
             # нормализуем к списку
             vals = value if isinstance(value, list) else [value]
-            vals = [str(v) for v in vals if v is not None]
 
+            # один проход: приведение к str + раскладка на выбранные/прочие
             selected: List[str] = []
             others: List[str] = []
+            sel_app, oth_app = selected.append, others.append
             for v in vals:
-                if v in choices:
-                    selected.append(v)
-                else:
-                    others.append(v)
+                if v is None:
+                    continue
+                sv = v if type(v) is str else str(v)
+                (sel_app if sv in choices_set else oth_app)(sv)
 
             if others:
                 if other_allowed:
@@ -102,46 +123,53 @@ class FormAnswerBuilder:
         self.answers[entry_id] = str(value)
 
     def build_pairs(self) -> Tuple[str, List[Tuple[str, str]]]:
-        pairs: List[Tuple[str, str]] = []
+        return self.action, list(self._iter_pairs())
+
+    def _iter_pairs(self) -> Iterator[Tuple[str, str]]:
         if self.fbzx:
-            pairs.append(("fbzx", self.fbzx))
+            yield ("fbzx", self.fbzx)
 
         for eid, val in self.answers.items():
-            q = self.q_by_id.get(eid) or {}
-            key = f"entry.{eid}"
-            other_key = q.get("other_response_key") or f"{key}.other_option_response"
-            other_value_flag = q.get("other_value", "__other_option__")
+            q = self._eid_to_q.get(eid) or {}
+            key, other_key, other_value_flag = self._field_keys.get(eid) or self._make_field_keys(eid, q)
             qtype = (q.get("type") or "").lower()
 
             if isinstance(val, dict) and "__other__" in val:
                 # выбрана опция "Другое"
-                pairs.append((key, str(other_value_flag)))
-                pairs.append((other_key, str(val["__other__"])))
+                yield (key, other_value_flag)
+                yield (other_key, str(val["__other__"]))
                 # чекбоксы могли иметь и обычные выбранные варианты
                 for sel in val.get("__selected__", []):
-                    pairs.append((key, str(sel)))
+                    yield (key, str(sel))
                 continue
 
             if qtype == "checkboxes" and isinstance(val, list):
                 for item in val:
-                    pairs.append((key, str(item)))
+                    yield (key, str(item))
                 continue
 
             # обычный случай
-            pairs.append((key, str(val)))
-
-        return self.action, pairs
+            yield (key, str(val))
 
     def submit(self, referer: Optional[str] = None) -> requests.Response:
-        action, pairs = self.build_pairs()
-        data = {}
-        # Google Forms допускает повторяющиеся ключи для чекбоксов;
-        # requests это умеет, если передать список tuples, поэтому
-        # здесь НЕ сводим в dict, а шлём как есть:
-        headers = {"User-Agent": self.ua}
+        # Google Forms допускает повторяющиеся ключи для чекбоксов,
+        # поэтому НЕ сводим в dict: кодируем пары как есть одним проходом
+        # и шлём готовое тело, без повторной обработки внутри requests.
+        body = urllib.parse.urlencode(list(self._iter_pairs())).encode("ascii")
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
         if referer:
             headers["Referer"] = referer
-        return requests.post(action, data=pairs, headers=headers, timeout=self.timeout)
+        return self._session.post(self.action, data=body, headers=headers, timeout=self.timeout)
+
+    def close(self) -> None:
+        """Закрывает HTTP-сессию (пул соединений)."""
+        self._session.close()
+
+    def __enter__(self) -> "FormAnswerBuilder":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
 
 
     # --------------------------- Вспомогательное ---------------------------
@@ -151,32 +179,46 @@ class FormAnswerBuilder:
         Выдаёт пары ('entry.<id>', 'value') для всех установленных ответов.
         Валидирует multiple_choice/dropdown/checkboxes при strict=True.
         """
-        for eid, raw in self._answers.items():
-            q = self._eid_to_q.get(str(eid)) or {}
+        for eid, raw in self.answers.items():
+            q = self._eid_to_q.get(eid) or {}
             qtype = (q.get("type") or "").lower()
-            options = set(q.get("choices_or_rows") or [])
-
-            def _emit(val):
-                yield (f"entry.{eid}", str(val))
+            key, other_key, other_value_flag = self._field_keys.get(eid) or self._make_field_keys(eid, q)
+            # кэшированный frozenset из __init__: успешная проверка — один hash-lookup,
+            # сортировка вариантов — только в _bad_opt_msg при ошибке
+            choices_set = self._choices_set.get(eid, frozenset())
+            check = self.strict and bool(choices_set)
+
+            # "Другое" (как в _iter_pairs): флаг + свободный текст, у чекбоксов — и выбранные варианты
+            if isinstance(raw, dict) and "__other__" in raw:
+                yield (key, other_value_flag)
+                yield (other_key, str(raw["__other__"]))
+                for sel in raw.get("__selected__", []):
+                    sv = str(sel)
+                    if check and sv not in choices_set:
+                        raise ValueError(self._bad_opt_msg(q, sel, choices_set))
+                    yield (key, sv)
+                continue
 
             # чекбоксы
             if qtype == "checkboxes":
                 vals = raw if isinstance(raw, (list, tuple, set)) else [raw]
                 for v in vals:
-                    if self.strict and options and str(v) not in options:
-                        raise ValueError(self._bad_opt_msg(q, v, options))
-                    yield from _emit(v)
+                    sv = str(v)
+                    if check and sv not in choices_set:
+                        raise ValueError(self._bad_opt_msg(q, v, choices_set))
+                    yield (key, sv)
                 continue
 
             # одиночный выбор
+            sv = str(raw)
             if qtype in ("multiple_choice", "dropdown"):
-                if self.strict and options and str(raw) not in options:
-                    raise ValueError(self._bad_opt_msg(q, raw, options))
-                yield from _emit(raw)
+                if check and sv not in choices_set:
+                    raise ValueError(self._bad_opt_msg(q, raw, choices_set))
+                yield (key, sv)
                 continue
 
             # прочие типы — как строку
-            yield from _emit(raw)
+            yield (key, sv)
 
     def available_options(self, key: Union[str, int]) -> List[str]:
         """
@@ -192,17 +234,23 @@ class FormAnswerBuilder:
             eid = self._index_to_eid.get(int(key))
             if not eid:
                 raise KeyError(f"Нет entry_id у вопроса с индексом {key}")
-            return self._eid_to_q.get(str(eid), {})
+            return self._eid_to_q.get(eid, {})
         # текст или entry_id
         if isinstance(key, str) and not key.isdigit():
-            eid = self._text_to_eid.get(self._norm(key))
+            eid = self._text_to_eid.get(norm(key))
             if not eid:
                 raise KeyError(f"Не найден вопрос с текстом: {key!r}")
-            return self._eid_to_q.get(str(eid), {})
+            return self._eid_to_q.get(eid, {})
         # entry_id
-        return self._eid_to_q.get(str(key), {})
+        return self._eid_to_q.get(key, {})
+
+    @staticmethod
+    def _make_field_keys(eid: str, q: Dict[str, Any]) -> Tuple[str, str, str]:
+        key = f"entry.{eid}"
+        other_key = q.get("other_response_key") or f"{key}.other_option_response"
+        return key, other_key, str(q.get("other_value", "__other_option__"))
 
-    def _bad_opt_msg(self, q: Dict[str, Any], got: Any, options: Iterable[str]) -> str:
+    def _bad_opt_msg(self, q: Dict[str, Any], got: Any, options: FrozenSet[str]) -> str:
         return (f"Неверное значение '{got}' для вопроса: {q.get('text')!r}. "
                 f"Допустимые: {sorted(map(str, options))}")
 
@@ -210,9 +258,6 @@ class FormAnswerBuilder:
         meta = self.parsed.get("meta", {}) or {}
         return (meta.get("action") or "", meta.get("fbzx") or "")
 
-    @staticmethod
-    def _norm(s: str) -> str:
-        return re.sub(r"\s+", " ", (s or "")).strip().lower()
     def __iter__(self):
         """Итерируемся по всем вопросам как по словарям из parsed['questions']."""
         yield from (self.parsed.get("questions", []) or [])
@@ -225,9 +270,6 @@ class FormAnswerBuilder:
         Итерируемся по вопросам, у которых есть entry_id и пока нет ответа.
         Удобно для поэтапного заполнения.
         """
-        for q in (self.parsed.get("questions", []) or []):
-            eid = q.get("entry_id")
-            if not eid:
-                continue
-            if str(eid) not in self._answers:
+        for eid, q in self._eid_to_q.items():
+            if eid not in self.answers:
                 yield q
\ No newline at end of file
@@ -0,0 +1,101 @@
+# form_runner.py
+# -*- coding: utf-8 -*-
+"""
+Общий для main_groq / main_gemini параллельный прогон формы:
+вопросы режутся на секции, секции отвечаются в потоках (внутри — по порядку
+со своей историей Q→A), результаты пишутся в билдер в исходном порядке.
+"""
+from __future__ import annotations
+import threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from form_answer_builder import FormAnswerBuilder
+from qa_context import QACache, is_section_header
+
+__all__ = [
+    "RateLimiter",
+    "split_section_runs",
+    "answer_runs",
+]
+
+Question = Dict[str, Any]
+
+
+class RateLimiter:
+    """Общий для всех потоков интервал между стартами запросов (вместо time.sleep в цикле)."""
+
+    def __init__(self, interval: float):
+        self.interval = max(0.0, interval)
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def split_section_runs(questions: List[Question], reset_on_section: bool = True) -> List[List[Question]]:
+    """
+    Режет вопросы (только с entry_id) на прогоны: новый прогон — на каждом заголовке секции '1.'/'2.'...
+    История Q→A сбрасывается на секции, поэтому прогоны друг от друга не зависят
+    и их можно отвечать параллельно (внутри прогона — по порядку).
+    """
+    runs: List[List[Question]] = [[]]
+    for q in questions:
+        if not q.get("entry_id"):
+            continue
+        if reset_on_section and runs[-1] and is_section_header(q.get("text") or ""):
+            runs.append([])
+        runs[-1].append(q)
+    return [r for r in runs if r]
+
+
+def answer_runs(
+    questions: List[Question],
+    answer_run: Callable[[List[Question], QACache], List[Optional[Any]]],
+    *,
+    builder: FormAnswerBuilder,
+    qa_cache: QACache,
+    max_workers: int = 8,
+    reset_on_section: bool = True,
+) -> None:
+    """
+    answer_run(run, history) -> значения по вопросам прогона (None — пропуск).
+    Прогон с заголовка секции стартует с пустой историей, остальные — с копии qa_cache.
+    Запись в builder и qa_cache — после всех потоков, в исходном порядке вопросов.
+    """
+    runs = split_section_runs(questions, reset_on_section)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as ex:
+        futures = []
+        for run in runs:
+            starts_section = reset_on_section and is_section_header(run[0].get("text") or "")
+            history = QACache(persist=False) if starts_section else qa_cache.copy()
+            futures.append(ex.submit(answer_run, run, history))
+        results = [fut.result() for fut in futures]
+
+    for run, values in zip(runs, results):
+        for q, value in zip(run, values):
+            eid = q.get("entry_id")
+            q_text = (q.get("text") or "")
+            # очистка истории при новой «большой» секции (1., 2., 3., ...)
+            if reset_on_section and is_section_header(q_text):
+                qa_cache.clear()
+            if value is None:
+                continue
+
+            try:
+                builder.set_answer(eid, value)
+                qa_cache.add(q_text, value)  # пополняем «память»
+
+                preview = value if isinstance(value, str) else ", ".join(map(str, value))
+                short_q = q_text.splitlines()[0][:80]
+                print(f"[{eid}] OK -> {preview}    ({short_q}...)")
+            except ValueError as e:
+                print(f"[{eid}] Валидатор отклонил ответ: {e}")
@@ -1,66 +1,121 @@
 from __future__ import annotations
 
+import functools
+import hashlib
 import json
 import os
+import pathlib
 import re
+import threading
 import time
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:  # опционально: потоковый разбор ответа Gemini
+    import ijson
+except ImportError:
+    ijson = None
+
+try:  # опционально: быстрый (C) JSON для тел запросов/ответов
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # опционально: нечёткое сопоставление ответа с вариантами на C
+    from rapidfuzz import fuzz, process as fuzz_process
+except ImportError:
+    fuzz = fuzz_process = None
 
 from form_answer_builder import FormAnswerBuilder
+from normalization import norm
 from parser import GFormParser
-from qa_context import QACache, make_section_context_map, RE_SECTION  # уже подключено ранее
+from qa_context import QACache, make_section_context_map  # уже подключено ранее
+from form_runner import RateLimiter, answer_runs
 
 GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
 MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite")
 TEMPERATURE = 0.1
 
-# --- ⬇⬇ новое: загрузка системного промпта из файла ---
-_SYSTEM_PROMPT_CACHE: Optional[str] = None
-
+# регулярки компилируем один раз — они дёргаются на каждый вопрос/вариант
+_RE_JSON_OBJ = re.compile(r"\{.*\}", re.S)
+_RE_COLON_TAIL = re.compile(r"[:\-–]\s*(.+)$")
+# разделители вариантов в ответе "A, B; C" — заменяем на один символ и режем str.split (без regex)
+_SEP_TABLE = str.maketrans(",;/\n", "\x1f\x1f\x1f\x1f")
+FUZZY_MIN_SCORE = 90  # порог rapidfuzz fuzz.ratio для принятия варианта
+# цифры и знаки, которые нечёткое сравнение не имеет права «поправить» (x = -2 ≠ x = 2)
+_RE_MATH_CHARS = re.compile(r"[^\d+\-−*/^=<>%]+")
 
+# --- ⬇⬇ новое: загрузка системного промпта из файла ---
+@functools.lru_cache(maxsize=1)
 def load_system_prompt() -> str:
     """Читает системный промпт из файла (по умолчанию system_prompt.txt).
-       Путь можно задать через SYSTEM_PROMPT_PATH. Кэширует результат."""
-    global _SYSTEM_PROMPT_CACHE
-    if _SYSTEM_PROMPT_CACHE is not None:
-        return _SYSTEM_PROMPT_CACHE
+       Путь можно задать через SYSTEM_PROMPT_PATH. Кэширует результат (lru_cache)."""
     path = os.getenv("SYSTEM_PROMPT_PATH", "system_prompt.txt")
     try:
         with open(path, "r", encoding="utf-8") as f:
-            _SYSTEM_PROMPT_CACHE = f.read().strip()
-            if not _SYSTEM_PROMPT_CACHE:
-                raise ValueError("system_prompt.txt пустой")
+            txt = f.read().strip()
+        if not txt:
+            raise ValueError("system_prompt.txt пустой")
+        return txt
     except Exception as e:
         # Фолбэк, если файла нет/пустой
-        _SYSTEM_PROMPT_CACHE = (
-            "Ты математик. Отвечай кратко и точно. Верни ТОЛЬКО JSON по инструкции."
-        )
         print(f"[warn] Не удалось загрузить системный промпт из {path}: {e}. "
               f"Использую дефолтный короткий промпт.")
-    return _SYSTEM_PROMPT_CACHE
+        return "Ты математик. Отвечай кратко и точно. Верни ТОЛЬКО JSON по инструкции."
 
 
 # ----------- Клиент Gemini -----------
 
+def _json_body(payload: Any) -> bytes:
+    """UTF-8 JSON без \\uXXXX-экранирования кириллицы (requests json= кодирует с ensure_ascii=True)."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
 class GeminiClient:
     """
     Мини-клиент под Google Generative Language API (Gemini).
     Использует v1beta /models/{model}:generateContent
+    Ответы chat() кэшируются по хэшу (модель + payload): в памяти и в файлах
+      GEMINI_CACHE_DIR=cache/gemini   (каталог, по файлу <hash>.json на ответ)
+      GEMINI_NO_CACHE=1               (отключить кэш)
+      GEMINI_CACHE_MAX=2000           (LRU: столько ответов в памяти и файлов на диске)
+    В кэш попадают только ответы, прошедшие validate (см. chat).
+    Список моделей кэшируется в <GEMINI_CACHE_DIR>/meta/models.json (подкаталог — чтобы
+    чистка *.json ответов его не трогала): с ETag — перепроверка через If-None-Match (304),
+    без ETag — на MODELS_CACHE_TTL секунд; list_models(use_cache=False) всегда идёт в сеть.
     """
 
-    def __init__(self, api_key: str, base_url: str = GEMINI_BASE_URL, timeout: int = 60):
+    MODELS_CACHE_TTL = 24 * 3600
+
+    def __init__(self, api_key: str, base_url: str = GEMINI_BASE_URL, timeout: int = 60,
+                 pool_maxsize: int = 8):
         self.api_key = (api_key or "").strip().strip('"').strip("'")
         if not self.api_key:
             raise SystemExit("Не установлен GEMINI_API_KEY.")
         self.base_url = base_url.rstrip("/")
         self.timeout = timeout
         self.session = requests.Session()
+        # пул под параллельные запросы из answer_form_with_gemini
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize))
         self.session.headers.update({
             "Content-Type": "application/json",
             "Accept": "application/json",
         })
+        self.cache_enabled = os.getenv("GEMINI_NO_CACHE", "0") != "1"
+        self.cache_dir = pathlib.Path(os.getenv("GEMINI_CACHE_DIR", "cache/gemini"))
+        self.cache_max = max(1, int(os.getenv("GEMINI_CACHE_MAX", "2000")))
+        self._cache: "OrderedDict[str, str]" = OrderedDict()  # LRU: свежие — в конце
+        self._cache_lock = threading.Lock()
+        if self.cache_enabled:
+            self._prune_cache_dir()
+        self._sys_instruction_part: Optional[Dict[str, Any]] = None
+        self.models_cache_path = self.cache_dir / "meta" / "models.json"
+        self._models_cache: Optional[Dict[str, Any]] = None  # base_url -> {etag, body, fetched_at}
 
     def _raise_for_error(self, r: requests.Response):
         if r.status_code >= 400:
@@ -71,15 +126,47 @@ class GeminiClient:
                 msg = r.text
             raise RuntimeError(f"Gemini API error {r.status_code}: {msg}")
 
-    def list_models(self) -> list:
+    def _load_models_cache(self) -> Dict[str, Any]:
+        if self._models_cache is None:
+            try:
+                with self.models_cache_path.open("r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self._models_cache = data if isinstance(data, dict) else {}
+            except (OSError, ValueError):
+                self._models_cache = {}
+        return self._models_cache
+
+    def list_models(self, use_cache: bool = True) -> list:
         url = f"{self.base_url}/models?key={self.api_key}"
-        r = self.session.get(url, timeout=self.timeout)
+        cached = self._load_models_cache().get(self.base_url) if (use_cache and self.cache_enabled) else None
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            elif time.time() - cached.get("fetched_at", 0) < self.MODELS_CACHE_TTL:
+                return cached.get("body", [])
+
+        r = self.session.get(url, headers=headers, timeout=self.timeout)
+        if cached and r.status_code == 304:
+            cached["fetched_at"] = time.time()
+            self._write_json_atomic(self.models_cache_path, self._models_cache)
+            return cached.get("body", [])
         self._raise_for_error(r)
-        j = r.json()
-        return j.get("models", [])
+        models = r.json().get("models", [])
 
-    @staticmethod
-    def _messages_to_gemini_payload(messages: List[Dict[str, str]], temperature: float):
+        if self.cache_enabled:
+            self._load_models_cache()[self.base_url] = {
+                "etag": r.headers.get("ETag"), "body": models, "fetched_at": time.time(),
+            }
+            self._write_json_atomic(self.models_cache_path, self._models_cache)
+        return models
+
+    def set_system_instruction(self, text: str) -> None:
+        """Задаёт системный промпт один раз для всех последующих chat()."""
+        self._sys_instruction_part = {"role": "system", "parts": [{"text": text}]} if text else None
+
+    def _messages_to_gemini_payload(self, messages: List[Dict[str, str]], temperature: float):
+        # system в messages (если передан) перекрывает заданный через set_system_instruction
         sys_msgs = [m.get("content", "") for m in messages if (m.get("role") == "system")]
         non_sys = [m for m in messages if m.get("role") != "system"]
 
@@ -106,10 +193,106 @@ class GeminiClient:
                 "role": "system",
                 "parts": [{"text": "\n\n".join(sys_msgs)}],
             }
+        elif self._sys_instruction_part:
+            payload["systemInstruction"] = self._sys_instruction_part
         return payload
 
+    @staticmethod
+    def _read_text(data: Any) -> str:
+        try:
+            cand = data["candidates"][0]
+            parts = cand["content"]["parts"]
+            return "".join(p.get("text", "") for p in parts)
+        except Exception as e:
+            raise RuntimeError(f"Неожиданный ответ Gemini: {data}") from e
+
+    @staticmethod
+    def _read_stream_text(r: requests.Response) -> str:
+        """Разбирает тело ответа потоком: берёт candidates[0] и promptFeedback (причина блокировки),
+           остальные ключи верхнего уровня не сохраняются."""
+        r.raw.decode_content = True  # gzip/deflate от сервера
+        data: Dict[str, Any] = {}
+        try:
+            for key, value in ijson.kvitems(r.raw, ""):  # читает тело до конца — соединение вернётся в пул
+                if key == "candidates" and isinstance(value, list):
+                    data[key] = value[:1]
+                elif key == "promptFeedback":
+                    data[key] = value
+        except ijson.JSONError as e:
+            raise RuntimeError(f"Неожиданный ответ Gemini: {e}") from e
+        return GeminiClient._read_text(data)
+
+    # --- кэш ответов ---
+
+    @staticmethod
+    def _cache_key(model: str, payload: Dict[str, Any]) -> str:
+        raw = json.dumps({"model": model, "payload": payload}, sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        with self._cache_lock:
+            hit = self._cache.get(key)
+            if hit is not None:
+                self._cache.move_to_end(key)
+        if hit is not None:
+            return hit
+        path = self.cache_dir / f"{key}.json"
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                hit = json.load(f)["content"]
+            os.utime(path)  # mtime = время последнего использования (для _prune_cache_dir)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(hit, str):
+            return None
+        self._remember(key, hit)
+        return hit
+
+    def _remember(self, key: str, content: str) -> None:
+        with self._cache_lock:
+            self._cache[key] = content
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_max:
+                self._cache.popitem(last=False)
+
+    def _cache_put(self, key: str, content: str) -> None:
+        self._remember(key, content)
+        self._write_json_atomic(self.cache_dir / f"{key}.json",
+                                {"content": content, "retrieved_at": time.time()})
+
+    def _prune_cache_dir(self) -> None:
+        """Оставляет на диске cache_max самых недавно использованных ответов (по mtime)."""
+        try:
+            files = [(p.stat().st_mtime, p) for p in self.cache_dir.glob("*.json")]
+        except OSError:
+            return
+        if len(files) <= self.cache_max:
+            return
+        files.sort(reverse=True)
+        for _, p in files[self.cache_max:]:
+            try:
+                p.unlink()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _write_json_atomic(path: pathlib.Path, obj: Any) -> None:
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tmp.open("w", encoding="utf-8") as f:
+                json.dump(obj, f, ensure_ascii=False)
+            os.replace(tmp, path)  # атомарно: параллельные потоки не увидят недописанный файл
+        except OSError as e:
+            print(f"[warn] Не удалось сохранить кэш Gemini {path}: {e}")
+
     def chat(self, messages: List[Dict[str, str]], model: str = MODEL,
-             temperature: float = TEMPERATURE, **extra) -> str:
+             temperature: float = TEMPERATURE, use_cache: bool = True,
+             validate: Optional[Callable[[str], bool]] = None,
+             limiter: Optional[RateLimiter] = None, **extra) -> str:
+        """validate(content) — годится ли ответ для кэша: непрошедший не сохраняется,
+           а такой же, найденный в кэше, игнорируется (запрос уходит заново).
+           limiter.wait() вызывается только перед реальным запросом — попадание в кэш не ждёт."""
         url = f"{self.base_url}/models/{model}:generateContent?key={self.api_key}"
         payload = self._messages_to_gemini_payload(messages, temperature)
         if extra:
@@ -117,73 +300,104 @@ class GeminiClient:
             for k, v in extra.items():
                 gen[k] = v
 
-        r = self.session.post(url, json=payload, timeout=self.timeout)
+        key = self._cache_key(model, payload) if (use_cache and self.cache_enabled) else None
+        if key:
+            hit = self._cache_get(key)
+            if hit is not None and (validate is None or validate(hit)):
+                return hit
+
+        if limiter is not None:
+            limiter.wait()
+        r = self.session.post(url, data=_json_body(payload), timeout=self.timeout, stream=ijson is not None)
         self._raise_for_error(r)
-        data = r.json()
-        try:
-            cand = data["candidates"][0]
-            parts = cand["content"]["parts"]
-            return "".join(p.get("text", "") for p in parts)
-        except Exception as e:
-            raise RuntimeError(f"Неожиданный ответ Gemini: {data}") from e
+        if ijson is not None:
+            content = self._read_stream_text(r)
+        else:
+            content = self._read_text(orjson.loads(r.content) if orjson is not None else r.json())
+
+        if key and (validate is None or validate(content)):
+            self._cache_put(key, content)
+        return content
 
 
 # ----------- Утилиты сопоставления вариантов -----------
 
-_ws = re.compile(r"\s+", re.S)
+OptionIndex = Tuple[Tuple[str, ...], Dict[str, str]]
 
 
-def _norm(s: str) -> str:
-    s = (s or "").strip().lower().replace("\xa0", " ")
-    return _ws.sub(" ", s)
+@functools.lru_cache(maxsize=256)
+def _build_option_index(options: Tuple[str, ...]) -> OptionIndex:
+    """(нормализованные варианты по порядку, {норм. вариант: оригинал}) — строится раз на набор вариантов."""
+    norm_opts = tuple(norm(o) for o in options)
+    by_norm: Dict[str, str] = {}
+    for no, o in zip(norm_opts, options):
+        by_norm.setdefault(no, o)
+    return norm_opts, by_norm
 
 
-def pick_single_option(answer_text: str, options: List[str]) -> Optional[str]:
+def pick_single_option(answer_text: str, options: List[str],
+                       index: Optional[OptionIndex] = None) -> Optional[str]:
     if not options:
         return None
-    norm_opts = [_norm(o) for o in options]
-    ans = _norm(answer_text)
+    norm_opts, by_norm = index or _build_option_index(tuple(options))
+    ans = norm(answer_text)
     if ans.isdigit():
         k = int(ans)
         if 1 <= k <= len(options):
             return options[k - 1]
-    for i, no in enumerate(norm_opts):
-        if ans == no:
-            return options[i]
-    m = re.search(r"[:\-–]\s*(.+)$", ans)
+    hit = by_norm.get(ans)
+    if hit is not None:
+        return hit
+    m = _RE_COLON_TAIL.search(ans)
     if m:
         ans2 = m.group(1).strip().strip("\"'«»")
-        for i, no in enumerate(norm_opts):
-            if ans2 == no:
-                return options[i]
+        hit = by_norm.get(ans2)
+        if hit is not None:
+            return hit
         ans = ans2
     hits = [i for i, no in enumerate(norm_opts) if ans in no or no in ans]
     if len(hits) == 1:
         return options[hits[0]]
+    if not hits and fuzz_process is not None:
+        return _fuzzy_pick(ans, options, norm_opts)
     return None
 
 
-def pick_multi_options(answer_text: str, options: List[str]) -> Optional[List[str]]:
+def _fuzzy_pick(ans: str, options: List[str], norm_opts: Tuple[str, ...]) -> Optional[str]:
+    """Последний шанс для опечаток: строго лучший вариант по fuzz.ratio (без ничьей),
+       и только если цифры/знаки в ответе и варианте совпадают."""
+    best = fuzz_process.extract(ans, norm_opts, scorer=fuzz.ratio, score_cutoff=FUZZY_MIN_SCORE, limit=2)
+    if not best or (len(best) > 1 and best[1][1] == best[0][1]):
+        return None
+    i = best[0][2]
+    if _RE_MATH_CHARS.sub("", norm_opts[i]) != _RE_MATH_CHARS.sub("", ans):
+        return None
+    return options[i]
+
+
+def pick_multi_options(answer_text: str, options: List[str],
+                       index: Optional[OptionIndex] = None) -> Optional[List[str]]:
     if not options:
         return None
+    index = index or _build_option_index(tuple(options))
     ans = answer_text.strip()
     try:
         val = json.loads(ans)
         if isinstance(val, list):
             picked = []
             for item in val:
-                match = pick_single_option(str(item), options)
+                match = pick_single_option(str(item), options, index)
                 if match and match not in picked:
                     picked.append(match)
             return picked or None
     except Exception:
         pass
-    parts = [p.strip() for p in re.split(r"[,;/\n]+", ans) if p.strip()]
+    parts = [p for p in (t.strip() for t in ans.translate(_SEP_TABLE).split("\x1f")) if p]
     if not parts:
         return None
     picked = []
     for p in parts:
-        match = pick_single_option(p, options)
+        match = pick_single_option(p, options, index)
         if match and match not in picked:
             picked.append(match)
     return picked or None
@@ -192,39 +406,41 @@ def pick_multi_options(answer_text: str, options: List[str]) -> Optional[List[st
 # ----------- Построение промпта -----------
 
 
+_INSTRUCT_CHOICE = (
+    "Верни только JSON.\n"
+    "Одиночный выбор: {\"answer\": \"ОДИН_ИЗ_ВАРИАНТОВ_ТОЧНО_КАК_В_СПИСКЕ\"}\n"
+    "Множественный: {\"answer\": [\"ВАР_1\", \"ВАР_2\"]}"
+)
+_INSTRUCT_TEXT = "Верни только JSON: {\"answer\": \"КОРОТКИЙ_ТЕКСТ\"}"
+
+
+@functools.lru_cache(maxsize=512)
+def _render_options_block(opts: Tuple[str, ...]) -> str:
+    """Блок «Варианты:» рендерится раз на набор вариантов (часто повторяется между вопросами)."""
+    return "Варианты:\n" + "\n".join(f"- {o}" for o in opts)
+
+
 def build_messages_for_question(
         q: Dict[str, Any],
         section_ctx: str = "",
         history_text: str = ""
 ) -> List[Dict[str, str]]:
-    """Формируем сообщения: system — из файла, user — контекст + вопрос."""
-    system_text = load_system_prompt()  # ⬅ читаем внешнее содержимое
-
+    """Формируем сообщения: только user — контекст + вопрос.
+       Системный промпт из файла задаётся клиенту один раз (GeminiClient.set_system_instruction)."""
     qtext = q.get("text") or ""
     qtype = (q.get("type") or "").lower()
     opts: List[str] = q.get("choices_or_rows") or []
 
-    blocks = []
-    if section_ctx:
-        blocks.append("Общий контекст:\n" + section_ctx.strip())
-    if history_text:
-        blocks.append(history_text.strip())
-    blocks.append("Вопрос:\n" + qtext.strip())
-    body = "\n\n".join(blocks) + "\n\n"
+    ctx = f"Общий контекст:\n{section_ctx.strip()}\n\n" if section_ctx else ""
+    hist = f"{history_text.strip()}\n\n" if history_text else ""
+    body = f"{ctx}{hist}Вопрос:\n{qtext.strip()}\n\n"
 
     if qtype in ("multiple_choice", "dropdown", "checkboxes") and opts:
-        instruct = (
-                body +
-                "Варианты:\n" + "\n".join(f"- {o}" for o in opts) + "\n\n"
-                                                                    "Верни только JSON.\n"
-                                                                    "Одиночный выбор: {\"answer\": \"ОДИН_ИЗ_ВАРИАНТОВ_ТОЧНО_КАК_В_СПИСКЕ\"}\n"
-                                                                    "Множественный: {\"answer\": [\"ВАР_1\", \"ВАР_2\"]}"
-        )
+        instruct = f"{body}{_render_options_block(tuple(opts))}\n\n{_INSTRUCT_CHOICE}"
     else:
-        instruct = body + "Верни только JSON: {\"answer\": \"КОРОТКИЙ_ТЕКСТ\"}"
+        instruct = body + _INSTRUCT_TEXT
 
     return [
-        {"role": "system", "content": system_text},  # ⬅ используем файл
         {"role": "user", "content": instruct},
     ]
 
@@ -234,7 +450,7 @@ def extract_answer_from_llm(raw_content: str) -> Optional[Any]:
         data = json.loads(raw_content)
         return data.get("answer")
     except Exception:
-        m = re.compile(r"\{.*\}", re.S).search(raw_content or "")
+        m = _RE_JSON_OBJ.search(raw_content or "")
         if m:
             try:
                 return json.loads(m.group(0)).get("answer")
@@ -245,94 +461,127 @@ def extract_answer_from_llm(raw_content: str) -> Optional[Any]:
 
 # ----------- Основной запуск -----------
 
-def answer_form_with_gemini(url: str, delay_sec: float = 0.3, do_submit: bool = False) -> None:
-    parsed = GFormParser(url).parse()
-    builder = FormAnswerBuilder(parsed, strict=True)
-    client = GeminiClient(api_key=os.getenv("GEMINI_API_KEY", ""))
-
-    # контекст секций и «память» предыдущих Q→A
-    section_ctx_map = make_section_context_map(parsed.get("questions", []))
-    qa_cache = QACache()
-    RESET_HISTORY_ON_NEW_SECTION = True
+def _resolve_value(q: Dict[str, Any], ans: Any) -> Optional[Any]:
+    """Маппит ответ модели на варианты вопроса (или «Другое»). None — не удалось."""
+    qtype = (q.get("type") or "").lower()
+    opts: List[str] = q.get("choices_or_rows") or []
 
-    # Sanity-check
-    try:
-        models = client.list_models()
-        if models:
-            print("Модели (срез):", [m.get("name", m) for m in models[:8]])
-    except Exception as e:
-        print("list_models:", e)
+    value: Optional[Any] = None
+    opt_index = _build_option_index(tuple(opts)) if opts else None  # раз на вопрос, для всех матчеров ниже
+    if qtype == "checkboxes" and opts:
+        if isinstance(ans, str):
+            value = pick_multi_options(ans, opts, opt_index)
+        else:
+            # список из модели: по порядку, без повторов (как в pick_multi_options)
+            picked: List[str] = []
+            seen = set()
+            for x in (ans if isinstance(ans, list) else []):
+                match = pick_single_option(str(x), opts, opt_index)
+                if match and match not in seen:
+                    seen.add(match)
+                    picked.append(match)
+            value = picked
+    elif qtype in ("multiple_choice", "dropdown") and opts:
+        value = (pick_single_option(str(ans[0]), opts, opt_index) if isinstance(ans, list) and ans
+                 else pick_single_option(str(ans), opts, opt_index))
+    else:
+        value = str(ans)
+
+    # >>> NEW: поддержка "Другое" (свободный ответ), если не заматчилось
+    if (not value or (isinstance(value, list) and not value)) and q.get("other_allowed"):
+        # берём текст из ans
+        other_text = None
+        if isinstance(ans, str):
+            other_text = ans.strip()
+        elif isinstance(ans, list) and ans:
+            other_text = str(ans[0]).strip()
+        if other_text:
+            # передадим в билдер спец-структуру с ключом "__other__"
+            value = {"__other__": other_text}
+
+    if not value or (isinstance(value, list) and not value):
+        return None
+    return value
 
-    try:
-        test = client.chat(
-            messages=[
-                {"role": "system", "content": "Отвечай одним словом."},
-                {"role": "user", "content": "ping"},
-            ],
-            model=MODEL, temperature=0.0,
-        )
-        print("Проверка chat OK:", test)
-    except Exception as e:
-        raise SystemExit(f"Chat не работает: {e}")
 
-    # Итерация по вопросам
-    for q in parsed.get("questions", []):
+def _answer_run(client: GeminiClient, run: List[Dict[str, Any]], section_ctx_map: Dict[str, str],
+                history: QACache, limiter: RateLimiter) -> List[Optional[Any]]:
+    """Последовательно отвечает на вопросы одного прогона (своя история), возвращает значения по порядку."""
+    values: List[Optional[Any]] = []
+    for q in run:
         eid = q.get("entry_id")
-        if not eid:
-            continue
-
-        q_text = (q.get("text") or "")
-        if RESET_HISTORY_ON_NEW_SECTION and RE_SECTION.match(q_text or ""):
-            qa_cache.clear()
-
-        qtype = (q.get("type") or "").lower()
-        opts: List[str] = q.get("choices_or_rows") or []
-
         section_ctx = section_ctx_map.get(str(eid), "")
-        history_text = qa_cache.as_text()
 
         try:
             content = client.chat(
-                messages=build_messages_for_question(q, section_ctx=section_ctx, history_text=history_text),
-                model=MODEL, temperature=TEMPERATURE
+                messages=build_messages_for_question(q, section_ctx=section_ctx, history_text=history.as_text()),
+                model=MODEL, temperature=TEMPERATURE,
+                validate=lambda c: extract_answer_from_llm(c) is not None,  # битый JSON не кэшируем
+                limiter=limiter,  # ждём только перед реальным запросом, не на попадании в кэш
             )
         except Exception as e:
             print(f"[{eid}] Ошибка запроса к Gemini: {e}")
+            values.append(None)
             continue
 
         ans = extract_answer_from_llm(content)
         if ans is None:
             print(f"[{eid}] Не удалось извлечь JSON-ответ: {content!r}")
+            values.append(None)
             continue
 
-        value: Optional[Any] = None
-        if qtype == "checkboxes" and opts:
-            value = (pick_multi_options(ans, opts) if isinstance(ans, str)
-                     else [o for o in (pick_single_option(str(x), opts) for x in (ans if isinstance(ans, list) else [])) if o])
-        elif qtype in ("multiple_choice", "dropdown") and opts:
-            value = (pick_single_option(str(ans[0]), opts) if isinstance(ans, list) and ans
-                     else pick_single_option(str(ans), opts))
-        else:
-            value = str(ans)
-
-        # >>> NEW: поддержка "Другое" (свободный ответ), если не заматчилось
-        if (not value or (isinstance(value, list) and not value)) and q.get("other_allowed"):
-            # берём текст из ans
-            other_text = None
-            if isinstance(ans, str):
-                other_text = ans.strip()
-            elif isinstance(ans, list) and ans:
-                other_text = str(ans[0]).strip()
-            if other_text:
-                # передадим в билдер спец-структуру с ключом "__other__"
-                value = {"__other__": other_text}
-
-        if not value or (isinstance(value, list) and not value):
+        value = _resolve_value(q, ans)
+        if value is None:
             print(f"[{eid}] Ответ получен, но не маппится на варианты. Пропуск.")
-            continue
+        else:
+            history.add(q.get("text") or "", value)
+        values.append(value)
+    return values
+
+
+def answer_form_with_gemini(url: str, delay_sec: float = 0.3, do_submit: bool = False,
+                            max_workers: int = 8) -> None:
+    parsed = GFormParser(url).parse()
+    builder = FormAnswerBuilder(parsed, strict=True)
+    client = GeminiClient(api_key=os.getenv("GEMINI_API_KEY", ""), pool_maxsize=max_workers)
 
-        if delay_sec > 0:
-            time.sleep(delay_sec)
+    # контекст секций и «память» предыдущих Q→A
+    section_ctx_map = make_section_context_map(parsed.get("questions", []))
+    qa_cache = QACache()
+    RESET_HISTORY_ON_NEW_SECTION = True
+
+    # Sanity-check (два лишних запроса) — только по AGF_SANITY=1,
+    # иначе ошибки ключа/сети всплывут на первом же вопросе
+    if os.getenv("AGF_SANITY", "0") == "1":
+        try:
+            models = client.list_models(use_cache=False)  # проверка ключа/сети — всегда запросом
+            if models:
+                print("Модели (срез):", [m.get("name", m) for m in models[:8]])
+        except Exception as e:
+            print("list_models:", e)
+
+        try:
+            test = client.chat(
+                messages=[
+                    {"role": "system", "content": "Отвечай одним словом."},
+                    {"role": "user", "content": "ping"},
+                ],
+                model=MODEL, temperature=0.0, use_cache=False,
+            )
+            print("Проверка chat OK:", test)
+        except Exception as e:
+            raise SystemExit(f"Chat не работает: {e}")
+
+    client.set_system_instruction(load_system_prompt())  # ⬅ один раз на всю форму
+
+    # Прогоны (секции) — параллельно, вопросы внутри прогона — по порядку со своей историей
+    limiter = RateLimiter(delay_sec)
+    answer_runs(
+        parsed.get("questions", []),
+        lambda run, history: _answer_run(client, run, section_ctx_map, history, limiter),
+        builder=builder, qa_cache=qa_cache, max_workers=max_workers,
+        reset_on_section=RESET_HISTORY_ON_NEW_SECTION,
+    )
 
     action, pairs = builder.build_pairs()
     print("\nСформирован payload для POST", action)
@@ -1,55 +1,69 @@
 # gform_groq_iter.py
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import os, json, re, time
-from typing import Any, Dict, List, Optional
+import os, json, re, bisect, hashlib, functools
+from typing import Any, Dict, List, Optional, Tuple
 import requests
+from requests.adapters import HTTPAdapter
+
+try:  # опционально: быстрый JSON на C
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # опционально: автомат Ахо–Корасик для поиска по длинным спискам вариантов
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 from parser import GFormParser                 # твой класс-парсер формы
 from form_answer_builder import FormAnswerBuilder  # билдер ответов
+from normalization import norm
 
 # ⬇️ новое: контекст + память Q→A из отдельного модуля
-from qa_context import QACache, make_section_context_map, RE_SECTION
+from qa_context import QACache, PromptAnswerCache, make_section_context_map
+from form_runner import RateLimiter, answer_runs
 
 GROQ_BASE_URL = "https://api.groq.com/openai/v1"
 CHAT_PATH = "/chat/completions"
 MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
 TEMPERATURE = 0.1
 
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 # ===== системный промпт читаем из файла =====
-_SYSTEM_PROMPT_CACHE: Optional[str] = None
+@functools.lru_cache(maxsize=1)
 def load_system_prompt() -> str:
     """Читает системный промпт из файла (по умолчанию system_prompt.txt).
-       Путь можно задать через SYSTEM_PROMPT_PATH. Результат кэшируется."""
-    global _SYSTEM_PROMPT_CACHE
-    if _SYSTEM_PROMPT_CACHE is not None:
-        return _SYSTEM_PROMPT_CACHE
+       Путь можно задать через SYSTEM_PROMPT_PATH. Результат кэшируется (lru_cache)."""
     path = os.getenv("SYSTEM_PROMPT_PATH", "system_prompt.txt")
     try:
         with open(path, "r", encoding="utf-8") as f:
             txt = f.read().strip()
-            if not txt:
-                raise ValueError("system_prompt.txt пустой")
-            _SYSTEM_PROMPT_CACHE = txt
+        if not txt:
+            raise ValueError("system_prompt.txt пустой")
+        return txt
     except Exception as e:
-        _SYSTEM_PROMPT_CACHE = (
-            "Ты математик. Отвечай кратко и точно. Верни ТОЛЬКО JSON по инструкции."
-        )
         print(f"[warn] Не удалось загрузить системный промпт из {path}: {e}. "
               f"Использую дефолтный короткий промпт.")
-    return _SYSTEM_PROMPT_CACHE
+        return "Ты математик. Отвечай кратко и точно. Верни ТОЛЬКО JSON по инструкции."
 
 
 # ----------- Клиент Groq -----------
 
 class GroqClient:
-    def __init__(self, api_key: str, base_url: str = GROQ_BASE_URL, timeout: int = 60):
+    _probed = False  # list_models уже проверен в этом процессе
+
+    def __init__(self, api_key: str, base_url: str = GROQ_BASE_URL, timeout: int = 60,
+                 pool_maxsize: int = 8):
         self.api_key = (api_key or "").strip().strip('"').strip("'")
         if not self.api_key:
             raise SystemExit("Не установлен GROQ_API_KEY.")
         self.base_url = base_url.rstrip("/")
         self.timeout = timeout
         self.session = requests.Session()
+        # пул под параллельные запросы из answer_form_with_groq
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize))
         self.session.headers.update({
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
@@ -85,110 +99,208 @@ class GroqClient:
 
 # ----------- Утилиты сопоставления вариантов -----------
 
-_ws = re.compile(r"\s+", re.S)
-def _norm(s: str) -> str:
-    s = (s or "").strip().lower().replace("\xa0", " ")
-    return _ws.sub(" ", s)
-
-def pick_single_option(answer_text: str, options: List[str]) -> Optional[str]:
+_RE_COLON_TAIL = re.compile(r"[:\-–]\s*(.+)$")
+_RE_MULTI_SEP = re.compile(r"[,;/\n]+")
+AC_MIN_OPTIONS = 32  # с какого числа вариантов подстрочный поиск идёт через автомат
+
+def build_norm_index(options: List[str]) -> Dict[str, str]:
+    """{нормализованный вариант: оригинал} — строится один раз на вопрос."""
+    index: Dict[str, str] = {}
+    for o in options:
+        index.setdefault(norm(o), o)
+    return index
+
+@functools.lru_cache(maxsize=64)
+def _substring_matcher(norm_keys: Tuple[str, ...]) -> Optional[Tuple[Any, str, List[int]]]:
+    """Для набора нормализованных вариантов: автомат по ним (no in ans)
+       и склейка через '\x00' с началами вариантов (ans in no). None — не применим."""
+    if any("\x00" in no for no in norm_keys):
+        return None
+    automaton = ahocorasick.Automaton()
+    for i, no in enumerate(norm_keys):
+        if no:
+            automaton.add_word(no, i)
+    automaton.make_automaton()
+    starts, pos = [], 0
+    for no in norm_keys:
+        starts.append(pos)
+        pos += len(no) + 1
+    return automaton, "\x00".join(norm_keys), starts
+
+def _substring_hits(ans: str, norm_keys: Tuple[str, ...]) -> Optional[set]:
+    """Индексы вариантов no, для которых ans in no или no in ans; None — считай циклом."""
+    matcher = _substring_matcher(norm_keys)
+    if matcher is None or not ans or "\x00" in ans:
+        return None
+    automaton, joined, starts = matcher
+    hits = {i for _, i in automaton.iter(ans)}          # no in ans
+    if "" in norm_keys:
+        hits.add(norm_keys.index(""))                   # пустая строка входит в любую
+    pos = joined.find(ans)                              # ans in no: поиск по склейке на C
+    while pos != -1:
+        i = bisect.bisect_right(starts, pos) - 1
+        hits.add(i)
+        pos = joined.find(ans, starts[i + 1]) if i + 1 < len(starts) else -1
+    return hits
+
+def pick_single_option(answer_text: str, options: List[str],
+                       norm_index: Optional[Dict[str, str]] = None) -> Optional[str]:
     if not options:
         return None
-    norm_opts = [_norm(o) for o in options]
-    ans = _norm(answer_text)
+    if norm_index is None:
+        norm_index = build_norm_index(options)
+    ans = norm(answer_text)
     if ans.isdigit():
         k = int(ans)
         if 1 <= k <= len(options):
             return options[k-1]
-    for i, no in enumerate(norm_opts):
-        if ans == no:
-            return options[i]
-    m = re.search(r"[:\-–]\s*(.+)$", ans)
+    hit = norm_index.get(ans)
+    if hit is not None:
+        return hit
+    m = _RE_COLON_TAIL.search(ans)
     if m:
         ans2 = m.group(1).strip().strip("\"'«»")
-        for i, no in enumerate(norm_opts):
-            if ans2 == no:
-                return options[i]
+        hit = norm_index.get(ans2)
+        if hit is not None:
+            return hit
         ans = ans2
-    hits = [i for i, no in enumerate(norm_opts) if ans in no or no in ans]
+    if ahocorasick is not None and len(norm_index) >= AC_MIN_OPTIONS:
+        norm_keys = tuple(norm_index)
+        idx = _substring_hits(ans, norm_keys)
+        if idx is not None:
+            return norm_index[norm_keys[idx.pop()]] if len(idx) == 1 else None
+    hits = [o for no, o in norm_index.items() if ans in no or no in ans]
     if len(hits) == 1:
-        return options[hits[0]]
+        return hits[0]
     return None
 
-def pick_multi_options(answer_text: str, options: List[str]) -> Optional[List[str]]:
+def pick_multi_options(answer_text: str, options: List[str],
+                       norm_index: Optional[Dict[str, str]] = None) -> Optional[List[str]]:
     if not options:
         return None
+    if norm_index is None:
+        norm_index = build_norm_index(options)
     ans = answer_text.strip()
-    try:
-        val = json.loads(ans)
+    # JSON-список пробуем, только если ответ начинается с '[' — обычный «A, B» идёт сразу в split
+    if ans[:1] == "[":
+        try:
+            val = _json_loads(ans)
+        except ValueError:
+            val = None
         if isinstance(val, list):
             picked = []
             for item in val:
-                match = pick_single_option(str(item), options)
+                match = pick_single_option(str(item), options, norm_index)
                 if match and match not in picked:
                     picked.append(match)
             return picked or None
-    except Exception:
-        pass
-    parts = [p.strip() for p in re.split(r"[,;/\n]+", ans) if p.strip()]
+    parts = [p.strip() for p in _RE_MULTI_SEP.split(ans) if p.strip()]
     if not parts:
         return None
     picked = []
     for p in parts:
-        match = pick_single_option(p, options)
+        match = pick_single_option(p, options, norm_index)
         if match and match not in picked:
             picked.append(match)
     return picked or None
 
 
 # ----------- Построение промпта -----------
+# Порядок сообщений: статичное (system + формат) -> контекст секций (один на форму)
+# -> история Q→A ходами user/assistant -> только новый вопрос. Общий префикс
+# совпадает между вопросами, и prompt caching у Groq его не пересчитывает.
+
+ANSWER_FORMATS = (
+    "Формат ответа — только JSON, вид указан в конце вопроса:\n"
+    "- «текст»: {\"answer\": \"КОРОТКИЙ_ТЕКСТ\"}\n"
+    "- «выбор»: одиночный {\"answer\": \"ОДИН_ИЗ_ВАРИАНТОВ_ТОЧНО_КАК_В_СПИСКЕ\"}, "
+    "множественный {\"answer\": [\"ВАР_1\", \"ВАР_2\"]}"
+)
+
+
+def build_form_prefix(section_ctx_map: Dict[str, str]) -> Tuple[List[Dict[str, str]], Dict[str, int]]:
+    """Статичные для всей формы сообщения и {entry_id: номер секции} для ссылок из вопросов."""
+    prefix = [{"role": "system", "content": load_system_prompt() + "\n\n" + ANSWER_FORMATS}]
+
+    numbers: Dict[str, int] = {}
+    for ctx in section_ctx_map.values():
+        if ctx and ctx not in numbers:
+            numbers[ctx] = len(numbers) + 1
+    if numbers:
+        prefix.append({
+            "role": "system",
+            "content": "Общий контекст секций формы:\n\n"
+                       + "\n\n".join(f"[{n}] {ctx.strip()}" for ctx, n in numbers.items()),
+        })
+    return prefix, {eid: numbers[ctx] for eid, ctx in section_ctx_map.items() if ctx}
+
+
+def answer_cache_tag(prefix: List[Dict[str, str]]) -> str:
+    """model_tag для PromptAnswerCache: модель, температура и дайджест промпта (системный + секции)."""
+    raw = json.dumps([MODEL, TEMPERATURE, prefix], ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
 
 def build_messages_for_question(
     q: Dict[str, Any],
     *,
-    section_ctx: str = "",
-    history_text: str = ""
+    prefix: List[Dict[str, str]],
+    section_no: Optional[int] = None,
+    history: Optional[List[Dict[str, str]]] = None
 ) -> List[Dict[str, str]]:
-    """Формируем сообщения: system — из файла, user — контекст + вопрос."""
-    system_text = load_system_prompt()
-
+    """prefix (из build_form_prefix) + история + сообщение только с текущим вопросом."""
     qtext = q.get("text") or ""
     qtype = (q.get("type") or "").lower()
     opts: List[str] = q.get("choices_or_rows") or []
 
     blocks = []
-    if section_ctx:
-        blocks.append("Общий контекст:\n" + section_ctx.strip())
-    if history_text:
-        blocks.append(history_text.strip())
+    if section_no:
+        blocks.append(f"Общий контекст: секция [{section_no}].")
     blocks.append("Вопрос:\n" + qtext.strip())
-    body = "\n\n".join(blocks) + "\n\n"
-
     if qtype in ("multiple_choice", "dropdown", "checkboxes") and opts:
-        instruct = (
-            body +
-            "Варианты:\n" + "\n".join(f"- {o}" for o in opts) + "\n\n"
-            "Верни только JSON.\n"
-            "Одиночный выбор: {\"answer\": \"ОДИН_ИЗ_ВАРИАНТОВ_ТОЧНО_КАК_В_СПИСКЕ\"}\n"
-            "Множественный: {\"answer\": [\"ВАР_1\", \"ВАР_2\"]}"
-        )
+        blocks.append("Варианты:\n" + "\n".join(f"- {o}" for o in opts))
+        blocks.append("Ответ: «выбор».")
     else:
-        instruct = body + "Верни только JSON: {\"answer\": \"КОРОТКИЙ_ТЕКСТ\"}"
+        blocks.append("Ответ: «текст».")
 
-    return [
-        {"role": "system", "content": system_text},
-        {"role": "user", "content": instruct},
-    ]
+    return [*prefix, *(history or []), {"role": "user", "content": "\n\n".join(blocks)}]
+
+
+def _find_json_object(s: str) -> Optional[str]:
+    """Первый сбалансированный {...} (с учётом строк и экранирования) — один проход без backtracking."""
+    i = s.find("{")
+    if i < 0:
+        return None
+    depth, in_str, esc = 0, False, False
+    for j in range(i, len(s)):
+        c = s[j]
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return s[i:j + 1]
+    return None
 
 
 def extract_answer_from_llm(raw_content: str) -> Optional[Any]:
     try:
-        data = json.loads(raw_content)
+        data = _json_loads(raw_content)
         return data.get("answer")
     except Exception:
-        m = re.search(r"\{.*\}", raw_content or "", flags=re.S)
-        if m:
+        obj = _find_json_object(raw_content or "")
+        if obj:
             try:
-                return json.loads(m.group(0)).get("answer")
+                return _json_loads(obj).get("answer")
             except Exception:
                 return None
     return None
@@ -196,109 +308,141 @@ def extract_answer_from_llm(raw_content: str) -> Optional[Any]:
 
 # ----------- Основной запуск -----------
 
-def answer_form_with_groq(url: str, delay_sec: float = 0.3, do_submit: bool = False) -> None:
-    parsed = GFormParser(url).parse()
-    builder = FormAnswerBuilder(parsed, strict=True)
-    client = GroqClient(api_key=os.getenv("GROQ_API_KEY", ""))
-
-    # контекст секций и «память» предыдущих Q→A
-    section_ctx_map = make_section_context_map(parsed.get("questions", []))
-    qa_cache = QACache()
-    RESET_HISTORY_ON_NEW_SECTION = True
+def _resolve_value(q: Dict[str, Any], ans: Any) -> Optional[Any]:
+    """Маппит ответ модели на варианты вопроса (или «Другое»). None — не удалось."""
+    qtype = (q.get("type") or "").lower()
+    opts: List[str] = q.get("choices_or_rows") or []
 
-    # sanity-check моделей и chat
-    try:
-        models = client.list_models()
-        if models:
-            print("Модели (срез):", [m.get("id", m) for m in models[:8]])
-    except Exception as e:
-        print("list_models:", e)
+    value: Optional[Any] = None
+    norm_index = build_norm_index(opts) if opts else None  # раз на вопрос, для всех матчеров ниже
+    if qtype == "checkboxes" and opts:
+        if isinstance(ans, str):
+            value = pick_multi_options(ans, opts, norm_index)
+        else:
+            # список из модели: по порядку, без повторов (как в pick_multi_options)
+            picked: List[str] = []
+            seen = set()
+            for x in (ans if isinstance(ans, list) else []):
+                match = pick_single_option(str(x), opts, norm_index)
+                if match and match not in seen:
+                    seen.add(match)
+                    picked.append(match)
+            value = picked
+    elif qtype in ("multiple_choice", "dropdown") and opts:
+        value = (pick_single_option(str(ans[0]), opts, norm_index) if isinstance(ans, list) and ans
+                 else pick_single_option(str(ans), opts, norm_index))
+    else:
+        value = str(ans)
+
+    # >>> NEW: поддержка "Другое" (свободный ответ), если не заматчилось
+    if (not value or (isinstance(value, list) and not value)) and q.get("other_allowed"):
+        # берём текст из ans
+        other_text = None
+        if isinstance(ans, str):
+            other_text = ans.strip()
+        elif isinstance(ans, list) and ans:
+            other_text = str(ans[0]).strip()
+        if other_text:
+            # передадим в билдер спец-структуру с ключом "__other__"
+            value = {"__other__": other_text}
+
+    if not value or (isinstance(value, list) and not value):
+        return None
+    return value
 
-    try:
-        test = client.chat(
-            messages=[
-                {"role": "system", "content": "Отвечай одним словом."},
-                {"role": "user", "content": "ping"},
-            ],
-            model=MODEL, temperature=0.0,
-        )
-        print("Проверка chat OK:", test)
-    except Exception as e:
-        raise SystemExit(f"Chat не работает: {e}")
 
-    # Итерация по вопросам
-    for q in parsed.get("questions", []):
+def _answer_run(
+    client: GroqClient,
+    run: List[Dict[str, Any]],
+    *,
+    prefix: List[Dict[str, str]],
+    section_no_by_eid: Dict[str, int],
+    section_ctx_map: Dict[str, str],
+    history: QACache,
+    answer_cache: PromptAnswerCache,
+    cache_tag: str,
+    limiter: RateLimiter,
+) -> List[Optional[Any]]:
+    """Последовательно отвечает на вопросы одного прогона (своя история), возвращает значения по порядку."""
+    values: List[Optional[Any]] = []
+    for q in run:
         eid = q.get("entry_id")
-        if not eid:
-            continue
-
         q_text = (q.get("text") or "")
-        # очистка истории при новой «большой» секции (1., 2., 3., ...)
-        if RESET_HISTORY_ON_NEW_SECTION and RE_SECTION.match(q_text or ""):
-            qa_cache.clear()
-
         qtype = (q.get("type") or "").lower()
         opts: List[str] = q.get("choices_or_rows") or []
 
-        section_ctx = section_ctx_map.get(str(eid), "")
-        history_text = qa_cache.as_text()
-
-        try:
-            content = client.chat(
-                messages=build_messages_for_question(
-                    q, section_ctx=section_ctx, history_text=history_text
-                ),
-                model=MODEL,
-                temperature=TEMPERATURE
-            )
-        except Exception as e:
-            print(f"[{eid}] Ошибка запроса к Groq: {e}")
-            continue
+        cache_key = PromptAnswerCache.make_key(q_text, opts, qtype, section_ctx_map.get(str(eid), ""), cache_tag)
+        content = answer_cache.get(cache_key)
+        from_cache = content is not None
+        if not from_cache:
+            limiter.wait()
+            try:
+                content = client.chat(
+                    messages=build_messages_for_question(
+                        q, prefix=prefix, section_no=section_no_by_eid.get(str(eid)),
+                        history=history.as_messages()
+                    ),
+                    model=MODEL,
+                    temperature=TEMPERATURE
+                )
+            except Exception as e:
+                print(f"[{eid}] Ошибка запроса к Groq: {e}")
+                values.append(None)
+                continue
 
         ans = extract_answer_from_llm(content)
         if ans is None:
             print(f"[{eid}] Не удалось извлечь JSON-ответ: {content!r}")
+            values.append(None)
             continue
+        if not from_cache:
+            answer_cache.put(cache_key, content)
 
-        value: Optional[Any] = None
-        if qtype == "checkboxes" and opts:
-            value = (pick_multi_options(ans, opts) if isinstance(ans, str)
-                     else [o for o in (pick_single_option(str(x), opts) for x in (ans if isinstance(ans, list) else [])) if o])
-        elif qtype in ("multiple_choice", "dropdown") and opts:
-            value = (pick_single_option(str(ans[0]), opts) if isinstance(ans, list) and ans
-                     else pick_single_option(str(ans), opts))
-        else:
-            value = str(ans)
-
-        # >>> NEW: поддержка "Другое" (свободный ответ), если не заматчилось
-        if (not value or (isinstance(value, list) and not value)) and q.get("other_allowed"):
-            # берём текст из ans
-            other_text = None
-            if isinstance(ans, str):
-                other_text = ans.strip()
-            elif isinstance(ans, list) and ans:
-                other_text = str(ans[0]).strip()
-            if other_text:
-                # передадим в билдер спец-структуру с ключом "__other__"
-                value = {"__other__": other_text}
-
-        if not value or (isinstance(value, list) and not value):
+        value = _resolve_value(q, ans)
+        if value is None:
             print(f"[{eid}] Ответ получен, но не маппится на варианты. Пропуск.")
-            continue
+        else:
+            history.add(q_text, value)
+        values.append(value)
+    return values
 
-        try:
-            builder.set_answer(eid, value)
-            qa_cache.add(q_text, value)  # пополняем «память»
-
-            preview = value if isinstance(value, str) else ", ".join(map(str, value))
-            short_q = q_text.splitlines()[0][:80]
-            print(f"[{eid}] OK -> {preview}    ({short_q}...)")
-        except ValueError as e:
-            print(f"[{eid}] Валидатор отклонил ответ: {e}")
-            continue
 
-        if delay_sec > 0:
-            time.sleep(delay_sec)
+def answer_form_with_groq(url: str, delay_sec: float = 0.3, do_submit: bool = False,
+                          max_workers: int = 8) -> None:
+    parsed = GFormParser(url).parse()
+    builder = FormAnswerBuilder(parsed, strict=True)
+    client = GroqClient(api_key=os.getenv("GROQ_API_KEY", ""), pool_maxsize=max_workers)
+
+    # контекст секций и «память» предыдущих Q→A
+    section_ctx_map = make_section_context_map(parsed.get("questions", []))
+    prefix, section_no_by_eid = build_form_prefix(section_ctx_map)
+    qa_cache = QACache()
+    answer_cache = PromptAnswerCache()  # сырые ответы модели: повторный вопрос — без запроса
+    RESET_HISTORY_ON_NEW_SECTION = True
+
+    # sanity-check: только list_models, один раз на процесс (chat проверит первый же вопрос)
+    if os.getenv("GROQ_SKIP_PROBE", "0") != "1" and not GroqClient._probed:
+        try:
+            models = client.list_models()
+            if models:
+                print("Модели (срез):", [m.get("id", m) for m in models[:8]])
+            GroqClient._probed = True
+        except Exception as e:
+            print("list_models:", e)
+
+    # Прогоны (секции) — параллельно, вопросы внутри прогона — по порядку со своей историей
+    limiter = RateLimiter(delay_sec)
+    cache_tag = answer_cache_tag(prefix)
+    answer_runs(
+        parsed.get("questions", []),
+        lambda run, history: _answer_run(
+            client, run,
+            prefix=prefix, section_no_by_eid=section_no_by_eid, section_ctx_map=section_ctx_map,
+            history=history, answer_cache=answer_cache, cache_tag=cache_tag, limiter=limiter,
+        ),
+        builder=builder, qa_cache=qa_cache, max_workers=max_workers,
+        reset_on_section=RESET_HISTORY_ON_NEW_SECTION,
+    )
 
     action, pairs = builder.build_pairs()
     print("\nСформирован payload для POST", action)
@@ -0,0 +1,15 @@
+# normalization.py
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+import functools, re
+
+__all__ = ["norm"]
+
+_RE_WS = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=4096)
+def norm(s: str) -> str:
+    """Нормализация для сравнения: lower + strip + схлопывание пробелов (в т.ч. \\xa0).
+       Кэшируется — одни и те же варианты/тексты встречаются во многих вопросах."""
+    return _RE_WS.sub(" ", (s or "").strip().lower().replace("\xa0", " "))
@@ -5,12 +5,41 @@ import json, re, sys, html
 import os
 from typing import Any, Dict, List, Optional, Tuple, Iterable
 import requests
+from requests.adapters import HTTPAdapter
 
 URL = "https://docs.google.com/forms/d/1z8uChzEqNhtdtYp4WNO8BoRuWHXVjeNyijQMiaG3QHc/viewform?edit_requested=true"
 OUTPUT_PATH = None
 PRETTY = True
 # --- ДОБАВЬ к импортам ---
 
+# разметка формы: <form action>, скрытое fbzx и поля entry.<id> (rest — остаток тега до '>')
+_META_RE = re.compile(
+    r'<form[^>]+action="(?P<action>[^"]+/formResponse)"'
+    r'|name="fbzx"\s+value="(?P<fbzx>[^"]+)"'
+    r'|name="entry\.(?P<entry>\d+)"(?P<rest>[^>]*)'
+)
+_ARIA_LABEL_RE = re.compile(r'\saria-label="([^"]+)"')
+_PLACEHOLDER_RE = re.compile(r'\splaceholder="([^"]+)"')
+# служебный JSON формы: ищем маркер через str.find, литерал вырезаем сканером скобок
+_FB_MARKER = "FB_PUBLIC_LOAD_DATA_"
+_FB_DECODER = json.JSONDecoder()
+_NORM_WS = re.compile(r"\s+")
+
+_SESSION: Optional[requests.Session] = None
+
+
+def get_session() -> requests.Session:
+    """Общая для всех GFormParser HTTP-сессия (keep-alive между загрузками форм).
+       Можно донастроить снаружи: ретраи, прокси, свои адаптеры."""
+    global _SESSION
+    if _SESSION is None:
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=20))
+        session.headers["User-Agent"] = GFormParser.DEFAULT_UA
+        _SESSION = session
+    return _SESSION
+
+
 class GFormParser:
     DEFAULT_UA = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
                   "(KHTML, like Gecko) Chrome/123.0 Safari/537.36")
@@ -57,12 +86,16 @@ class GFormParser:
         entry_ids = meta.get("entry_ids", []) or []
         eid_idx = 0
 
+        label_items = tuple(label_map.items())  # порядок вставки = приоритет при неточном совпадении
+
         def match_entry_by_label(qtext: str) -> Optional[str]:
             key = self._normalize(qtext)
-            if key in label_map:
-                return label_map[key]
-            for k, eid in label_map.items():
-                if key.startswith(k) or k.startswith(key) or key in k or k in key:
+            eid = label_map.get(key)
+            if eid is not None:
+                return eid
+            # startswith — частный случай вхождения, отдельная проверка не нужна
+            for k, eid in label_items:
+                if key in k or k in key:
                     return eid
             return None
 
@@ -72,26 +105,22 @@ class GFormParser:
                 continue
 
             # --- текст вопроса ---
+            scan: Dict[str, Any] = {}  # результат _scan_item(it): заполняется при первом fallback
             text = None
-            if isinstance(self._dig(it, [1]), str) and self._dig(it, [1]).strip():
-                text = self._dig(it, [1]).strip()
-            elif isinstance(self._dig(it, [0, 1]), str) and self._dig(it, [0, 1]).strip():
-                text = self._dig(it, [0, 1]).strip()
+            v1, v01 = self._dig(it, [1]), self._dig(it, [0, 1])
+            if isinstance(v1, str) and v1.strip():
+                text = v1.strip()
+            elif isinstance(v01, str) and v01.strip():
+                text = v01.strip()
             else:
-                for node in self._walk_lists(it):
-                    if isinstance(node, list):
-                        for v in node:
-                            if isinstance(v, str) and v.strip():
-                                text = v.strip()
-                                break
-                    if text:
-                        break
+                first_str = self._item_scan(it, scan)["first_str"]
+                text = first_str.strip() if first_str else None
             if not text:
                 continue
 
-            qtype = self._question_type(it)
-            required = self._is_required(it)
-            choices, cols = self._extract_choices(it)
+            qtype = self._question_type(it, scan)
+            required = self._is_required(it, scan)
+            choices, cols = self._extract_choices(it, scan)
 
             q: Dict[str, Any] = {"text": html.unescape(text), "type": qtype}
             if required is not None:
@@ -111,7 +140,7 @@ class GFormParser:
                 eid = match_entry_by_label(q["text"])
 
             if not eid:
-                eid = self._extract_entry_id_from_item_fb(it)
+                eid = self._extract_entry_id_from_item_fb(it, scan)
 
             q["entry_id"] = eid  # может остаться None
 
@@ -157,41 +186,66 @@ class GFormParser:
     # -------------------- Внутренние утилиты --------------------
 
     def _fetch_html(self, url: str) -> str:
-        r = requests.get(url, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
+        session = get_session()
+        # UA сессии — DEFAULT_UA; заголовок передаём, только если у парсера свой
+        headers = None if self.user_agent == session.headers.get("User-Agent") else {"User-Agent": self.user_agent}
+        r = session.get(url, headers=headers, timeout=self.timeout)
         r.raise_for_status()
         return r.text
 
     def _extract_fb_payload(self, page_html: str) -> Any:
-        m = re.search(r"var\s+FB_PUBLIC_LOAD_DATA_\s*=\s*(\[.+?\]);\s*</script>", page_html, flags=re.S)
-        if not m:
-            m = re.search(r"FB_PUBLIC_LOAD_DATA_\s*=\s*(\[.+?\]);", page_html, flags=re.S)
-        if not m:
-            raise RuntimeError("Не нашёл служебные данные формы (FB_PUBLIC_LOAD_DATA_). "
-                               "Форма может быть закрыта/требовать вход или изменилась разметка.")
-        return json.loads(m.group(1))
+        # FB_PUBLIC_LOAD_DATA_ = [...]; — raw_decode разбирает литерал с позиции '['
+        # и останавливается на его закрывающей скобке, остаток HTML не читается
+        n = len(page_html)
+        idx = page_html.find(_FB_MARKER)
+        while idx != -1:
+            i = idx + len(_FB_MARKER)
+            while i < n and page_html[i].isspace():
+                i += 1
+            if i < n and page_html[i] == "=":
+                i += 1
+                while i < n and page_html[i].isspace():
+                    i += 1
+                if i < n and page_html[i] == "[":
+                    try:
+                        return _FB_DECODER.raw_decode(page_html, i)[0]
+                    except ValueError:
+                        pass  # битый литерал — ищем следующее вхождение маркера
+            idx = page_html.find(_FB_MARKER, i)
+        raise RuntimeError("Не нашёл служебные данные формы (FB_PUBLIC_LOAD_DATA_). "
+                           "Форма может быть закрыта/требовать вход или изменилась разметка.")
 
     def _extract_form_meta(self, html_text: str, viewform_url: str) -> Dict[str, Any]:
-        m_action = re.search(r'<form[^>]+action="([^"]+/formResponse)"', html_text)
-        action = m_action.group(1) if m_action else viewform_url.replace("/viewform", "/formResponse").split("?", 1)[0]
-
-        m_fbzx = re.search(r'name="fbzx"\s+value="([^"]+)"', html_text)
-        fbzx = m_fbzx.group(1) if m_fbzx else ""
-
-        # entry.<id> по порядку
-        entries = re.findall(r'name="entry\.(\d+)"', html_text)
+        # один проход по HTML вместо пяти: action, fbzx и все entry.<id> (+ хвост их тега)
+        action = fbzx = ""
         seen = set(); entry_ids: List[str] = []
-        for e in entries:
-            if e not in seen:
-                entry_ids.append(e); seen.add(e)
-
-        # карта label/placeholder -> entry
-        label_to_entry: Dict[str, str] = {}
-        for m in re.finditer(r'name="entry\.(\d+)"[^>]*?\saria-label="([^"]+)"', html_text):
-            entry, label = m.group(1), m.group(2)
-            label_to_entry.setdefault(self._normalize(label), entry)
-        for m in re.finditer(r'name="entry\.(\d+)"[^>]*?\splaceholder="([^"]+)"', html_text):
-            entry, label = m.group(1), m.group(2)
-            label_to_entry.setdefault(self._normalize(label), entry)
+        by_aria: Dict[str, str] = {}
+        by_placeholder: Dict[str, str] = {}
+        for m in _META_RE.finditer(html_text):
+            entry = m.group("entry")
+            if entry:
+                # entry.<id> по порядку
+                if entry not in seen:
+                    entry_ids.append(entry); seen.add(entry)
+                rest = m.group("rest")
+                m_label = _ARIA_LABEL_RE.search(rest)
+                if m_label:
+                    by_aria.setdefault(self._normalize(m_label.group(1)), entry)
+                m_label = _PLACEHOLDER_RE.search(rest)
+                if m_label:
+                    by_placeholder.setdefault(self._normalize(m_label.group(1)), entry)
+            elif m.group("fbzx"):
+                fbzx = fbzx or m.group("fbzx")
+            elif m.group("action"):
+                action = action or m.group("action")
+
+        if not action:
+            action = viewform_url.replace("/viewform", "/formResponse").split("?", 1)[0]
+
+        # карта label/placeholder -> entry (aria-label приоритетнее)
+        label_to_entry: Dict[str, str] = by_aria
+        for label, entry in by_placeholder.items():
+            label_to_entry.setdefault(label, entry)
 
         return {"action": action, "fbzx": fbzx, "entry_ids": entry_ids, "label_to_entry": label_to_entry}
 
@@ -210,7 +264,43 @@ class GFormParser:
             return best
         raise RuntimeError("Не удалось найти список вопросов в данных формы.")
 
-    def _extract_choices(self, item: list) -> Tuple[Optional[List[str]], Optional[List[str]]]:
+    def _scan_item(self, item: list) -> Dict[str, Any]:
+        """Один обход item для всех fallback-веток (раньше каждая делала свой _walk_lists):
+             first_str    — первая непустая строка (текст вопроса),
+             first_bool   — первый bool (обязательность),
+             choices_node — самый длинный «список списков со строками» (варианты),
+             big_int      — самое длинное int >= 10_000 (entry_id).
+           Порядок обхода тот же, «первый найденный» совпадает с прежним."""
+        first_str = first_bool = choices_node = big_int = None
+        for node in self._walk_lists(item):
+            if node and (choices_node is None or len(node) > len(choices_node)) \
+                    and all(isinstance(x, list) for x in node):
+                sample = node[0]
+                if sample and any(isinstance(y, str) and y.strip() for y in sample):
+                    choices_node = node
+            for v in node:
+                if isinstance(v, str):
+                    if first_str is None and v.strip():
+                        first_str = v
+                elif isinstance(v, bool):
+                    if first_bool is None:
+                        first_bool = v
+                elif isinstance(v, int) and v >= 10_000:
+                    sv = str(v)
+                    if big_int is None or len(sv) > len(big_int):
+                        big_int = sv
+        return {"first_str": first_str, "first_bool": first_bool,
+                "choices_node": choices_node, "big_int": big_int}
+
+    def _item_scan(self, item: list, scan: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        # scan — словарь-кэш от вызывающего на один item; пустой — обходим сейчас
+        if scan is None:
+            return self._scan_item(item)
+        if not scan:
+            scan.update(self._scan_item(item))
+        return scan
+
+    def _extract_choices(self, item: list, scan: Optional[Dict[str, Any]] = None) -> Tuple[Optional[List[str]], Optional[List[str]]]:
         node = self._dig(item, [4, 0, 1])
         if isinstance(node, list) and node and all(isinstance(x, list) for x in node):
             choices = []
@@ -231,13 +321,7 @@ class GFormParser:
             return (choices or None), cols
 
         # fallback: «список списков со строками»
-        best_list = None
-        for node in self._walk_lists(item):
-            if isinstance(node, list) and node and all(isinstance(x, list) for x in node):
-                sample = node[0]
-                if sample and any(isinstance(y, str) and y.strip() for y in sample):
-                    if best_list is None or len(node) > len(best_list):
-                        best_list = node
+        best_list = self._item_scan(item, scan)["choices_node"]
         if best_list:
             choices = []
             for ch in best_list:
@@ -249,7 +333,7 @@ class GFormParser:
                 return choices, None
         return None, None
 
-    def _is_required(self, item: list) -> Optional[bool]:
+    def _is_required(self, item: list, scan: Optional[Dict[str, Any]] = None) -> Optional[bool]:
         node = self._dig(item, [4, 0])
         if isinstance(node, list):
             for v in node[::-1]:
@@ -259,24 +343,20 @@ class GFormParser:
                     for vv in v[::-1]:
                         if isinstance(vv, bool):
                             return vv
-        for node in self._walk_lists(item):
-            for v in node:
-                if isinstance(v, bool):
-                    return v
-        return None
+        return self._item_scan(item, scan)["first_bool"]
 
-    def _question_type(self, item: list) -> str:
+    def _question_type(self, item: list, scan: Optional[Dict[str, Any]] = None) -> str:
         t = self._dig(item, [3])
         if isinstance(t, int) and t in self.TYPE_MAP:
             return self.TYPE_MAP[t]
-        choices, cols = self._extract_choices(item)
+        choices, cols = self._extract_choices(item, scan)
         if choices and cols:
             return "grid"
         if choices:
             return "choice"
         return "text"
 
-    def _extract_entry_id_from_item_fb(self, item: list) -> Optional[str]:
+    def _extract_entry_id_from_item_fb(self, item: list, scan: Optional[Dict[str, Any]] = None) -> Optional[str]:
         for path in ([4,0,0], [4,0,3,0], [4,0,0,0], [0]):
             v = self._dig(item, path)
             if isinstance(v, int) and v >= 10_000:
@@ -285,14 +365,7 @@ class GFormParser:
                 for x in v:
                     if isinstance(x, int) and x >= 10_000:
                         return str(x)
-        best = None
-        for node in self._walk_lists(item):
-            for val in node:
-                if isinstance(val, int) and val >= 10_000:
-                    s = str(val)
-                    if best is None or len(s) > len(best):
-                        best = s
-        return best
+        return self._item_scan(item, scan)["big_int"]
 
     # -------------------- статические утилиты --------------------
 
@@ -307,16 +380,22 @@ class GFormParser:
 
     @staticmethod
     def _walk_lists(x: Any):
-        if isinstance(x, list):
-            yield x
-            for v in x:
-                yield from GFormParser._walk_lists(v)
+        # обход в глубину тем же порядком (pre-order), что и рекурсивный, но на явном стеке:
+        # без генератора и yield from на каждый уровень вложенности
+        if not isinstance(x, list):
+            return
+        stack = [x]
+        pop, push = stack.pop, stack.extend
+        while stack:
+            node = pop()
+            yield node
+            push([v for v in reversed(node) if isinstance(v, list)])
 
     @staticmethod
     def _normalize(s: str) -> str:
         s = s or ""
         s = s.replace("\xa0", " ")
-        s = re.sub(r"\s+", " ", s, flags=re.S)
+        s = _NORM_WS.sub(" ", s)
         s = s.strip().lower()
         return s
 
@@ -1,69 +1,145 @@
 # qa_context.py
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import os, json, re, threading, pathlib
-from typing import Any, Dict, List, Optional
+import os, json, re, time, atexit, threading, pathlib, hashlib
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence
+
+from normalization import norm
+
+try:  # опционально: быстрый JSON на C
+    import orjson
+except ImportError:
+    orjson = None
 
 __all__ = [
     "QACache",
+    "PromptAnswerCache",
     "RE_SECTION",
     "RE_SUBPART",
     "make_section_context_map",
+    "is_section_header",
     "extract_section_intro",
 ]
 
+def _read_json(path: pathlib.Path) -> Any:
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
+    with path.open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_json(path: pathlib.Path, data: Any) -> None:
+    # через временный файл + os.replace: при падении на диске не останется недописанный JSON
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    if orjson is not None:
+        tmp.write_bytes(orjson.dumps(data))
+    else:
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class _BatchedSave:
+    """
+    Пакетная запись в self.path: файл переписывается раз в SAVE_EVERY изменений
+    или SAVE_INTERVAL сек, остаток — при выходе (atexit) или по flush().
+    Наследник задаёт path, _lock и передаёт в _init_batched_save функцию snapshot() — что писать в JSON.
+    """
+    SAVE_EVERY = 5
+    SAVE_INTERVAL = 2.0
+
+    def _init_batched_save(self, snapshot: Callable[[], Any]):
+        self._snapshot = snapshot
+        self._dirty = 0  # изменений с последней записи
+        self._last_save = time.monotonic()
+        if self.path:
+            atexit.register(self.flush)
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            with self._lock:
+                _write_json(self.path, self._snapshot())
+                self._dirty = 0
+                self._last_save = time.monotonic()
+        except Exception:
+            pass
+
+    def _mark_dirty(self):
+        if not self.path:
+            return
+        with self._lock:
+            self._dirty += 1
+            due = self._dirty >= self.SAVE_EVERY or time.monotonic() - self._last_save > self.SAVE_INTERVAL
+        if due:
+            self._save()
+
+    def flush(self):
+        """Дописывает несохранённые изменения на диск."""
+        if self._dirty:
+            self._save()
+
+
 # ============ КЭШ Q→A ДЛЯ КОНТЕКСТА ============
-class QACache:
+class QACache(_BatchedSave):
     """
     Хранит последние Q→A для подмешивания в промпт.
     Настройки через env:
       QA_CACHE_PATH=/tmp/qa.json   (опц. путь для сохранения)
       QA_CACHE_MAX_PAIRS=5         (по умолч. 5)
       QA_CACHE_MAX_CHARS=900       (лимит символов)
+    persist=False — только в памяти, файл не читается и не пишется.
+    Файл пишется пачками (раз в SAVE_EVERY изменений или SAVE_INTERVAL сек) и при выходе (atexit);
+    принудительно — flush().
     """
-    def __init__(self):
-        self.path = pathlib.Path(os.getenv("QA_CACHE_PATH", "")) if os.getenv("QA_CACHE_PATH") else None
+    def __init__(self, persist: bool = True):
+        self.path = pathlib.Path(os.getenv("QA_CACHE_PATH", "")) if persist and os.getenv("QA_CACHE_PATH") else None
         self.max_pairs = int(os.getenv("QA_CACHE_MAX_PAIRS", "5"))
         self.max_chars = int(os.getenv("QA_CACHE_MAX_CHARS", "900"))
         self._lock = threading.Lock()
-        self.pairs: List[Dict[str, str]] = []
+        self.pairs: Deque[Dict[str, str]] = deque()
+        self._char_len = 0  # сумма _pair_len по pairs, ведётся инкрементально
         self._load()
+        self._init_batched_save(lambda: list(self.pairs))
 
     def _load(self):
         if not self.path or not self.path.exists():
             return
         try:
-            self.pairs = json.load(self.path.open("r", encoding="utf-8"))
+            self.pairs = deque(_read_json(self.path))
         except Exception:
-            self.pairs = []
+            self.pairs = deque()
+        self._char_len = sum(map(self._pair_len, self.pairs))
 
-    def _save(self):
-        if not self.path:
-            return
-        try:
-            with self._lock, self.path.open("w", encoding="utf-8") as f:
-                json.dump(self.pairs, f, ensure_ascii=False)
-        except Exception:
-            pass
+    def copy(self) -> "QACache":
+        """Копия текущей истории только в памяти — для обработки секции в отдельном потоке."""
+        other = QACache(persist=False)
+        other.max_pairs, other.max_chars = self.max_pairs, self.max_chars
+        other.pairs = deque(self.pairs)
+        other._char_len = self._char_len
+        return other
 
     def clear(self):
-        self.pairs = []
-        self._save()
+        self.pairs.clear()
+        self._char_len = 0
+        self._mark_dirty()
 
-    def _len_chars(self) -> int:
-        return sum(len(p.get("q","")) + len(p.get("a","")) + 6 for p in self.pairs)
+    @staticmethod
+    def _pair_len(p: Dict[str, str]) -> int:
+        return len(p.get("q","")) + len(p.get("a","")) + 6
 
     def add(self, q_text: str, answer: Any):
         q = (q_text or "").strip().replace("\n", " ")
         a = (", ".join(map(str, answer)) if isinstance(answer, list) else str(answer)).strip().replace("\n", " ")
-        self.pairs.append({"q": q[:200], "a": a[:200]})
-        # урежем по числу пар
-        while len(self.pairs) > self.max_pairs:
-            self.pairs.pop(0)
-        # урежем по символам
-        while self._len_chars() > self.max_chars and self.pairs:
-            self.pairs.pop(0)
-        self._save()
+        pair = {"q": q[:200], "a": a[:200]}
+        self.pairs.append(pair)
+        self._char_len += self._pair_len(pair)
+        # урежем по числу пар, затем по символам (старые — слева)
+        while len(self.pairs) > self.max_pairs or (self._char_len > self.max_chars and self.pairs):
+            self._char_len -= self._pair_len(self.pairs.popleft())
+        self._mark_dirty()
 
     def as_text(self) -> str:
         if not self.pairs:
@@ -71,15 +147,89 @@ class QACache:
         lines = [f"- Q: {p['q']} | A: {p['a']}" for p in self.pairs]
         return "Предыдущие вопросы и ответы (для контекста):\n" + "\n".join(lines)
 
+    def as_messages(self) -> List[Dict[str, str]]:
+        """История как реальные ходы user/assistant — растущий общий префикс для кэша промпта."""
+        msgs: List[Dict[str, str]] = []
+        for p in self.pairs:
+            msgs.append({"role": "user", "content": "Вопрос:\n" + p["q"]})
+            msgs.append({"role": "assistant", "content": json.dumps({"answer": p["a"]}, ensure_ascii=False)})
+        return msgs
+
+# ============ КЭШ ОТВЕТОВ МОДЕЛИ (пропуск повторных запросов) ============
+class PromptAnswerCache(_BatchedSave):
+    """
+    Хранит сырой ответ модели по ключу «вопрос + контекст секции + варианты + тип + model_tag»,
+    чтобы не спрашивать LLM повторно (в этом и следующих запусках).
+    model_tag — модель, температура и дайджест промпта: при их смене старые ответы не подаются.
+    Настройки через env:
+      QA_ANSWER_CACHE_PATH=/tmp/answers.json   (опц. путь для сохранения)
+      QA_ANSWER_CACHE_MAX=2000                 (LRU: столько ответов в памяти и в файле)
+    Файл пишется пачками, как у QACache.
+    """
+    def __init__(self):
+        self.path = pathlib.Path(os.getenv("QA_ANSWER_CACHE_PATH", "")) if os.getenv("QA_ANSWER_CACHE_PATH") else None
+        self.max_entries = max(1, int(os.getenv("QA_ANSWER_CACHE_MAX", "2000")))
+        self._lock = threading.Lock()
+        self.entries: "OrderedDict[str, str]" = OrderedDict()  # LRU: свежие — в конце
+        self._load()
+        # dict(): orjson пишет OrderedDict в порядке вставки, без учёта move_to_end
+        self._init_batched_save(lambda: dict(self.entries))
+
+    def _load(self):
+        if not self.path or not self.path.exists():
+            return
+        try:
+            data = _read_json(self.path)
+            self.entries = OrderedDict(data) if isinstance(data, dict) else OrderedDict()
+        except Exception:
+            self.entries = OrderedDict()
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def make_key(q_text: str, options: Sequence[str] = (), qtype: str = "", section_ctx: str = "",
+                 model_tag: str = "") -> str:
+        raw = "|".join((norm(q_text), norm(section_ctx), "\x1f".join(options or ()), (qtype or "").lower(),
+                        model_tag))
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            hit = self.entries.get(key)
+            if hit is not None:
+                self.entries.move_to_end(key)  # порядок попадёт в файл со следующей записью
+        return hit
+
+    def put(self, key: str, content: str):
+        with self._lock:  # put зовут из потоков; _save дампит словарь под тем же локом
+            self.entries[key] = content
+            self.entries.move_to_end(key)
+            self._evict()
+        self._mark_dirty()
+
 # ============ СЕКЦИОННЫЙ КОНТЕКСТ (общий стем) ============
 RE_SECTION = re.compile(r"^\s*(\d+)[\.\)]\s*", re.I)          # "1." / "2)"
 RE_SUBPART = re.compile(r"^\s*([a-zа-я])[\)\.]\s*", re.I)     # "a)" / "б)"
 RE_SPLIT_FIRST_SUB = re.compile(r"\n\s*[a-zа-я][\)\.]\s+", re.I)
 
+# Дешёвые проверки префикса до regex: секция начинается с цифры,
+# подпункт — с буквы и ')'/'.'. t — уже без ведущих пробелов.
+def _is_section(t: str) -> bool:
+    return t[:1].isdigit() and RE_SECTION.match(t) is not None
+
+def is_section_header(text: str) -> bool:
+    """Начинается ли текст вопроса с номера секции '1.'/'2)'..."""
+    return _is_section((text or "").lstrip())
+
+def _is_subpart(t: str) -> bool:
+    return t[:1].isalpha() and t[1:2] in (")", ".") and RE_SUBPART.match(t) is not None
+
 def extract_section_intro(text: str) -> str:
     """Возвращает общий стем секции: часть до первого подпункта 'a)/б)/в)'."""
-    m = RE_SECTION.match(text or "")
-    if not m:
+    if not _is_section((text or "").lstrip()):
         return ""
     parts = RE_SPLIT_FIRST_SUB.split(text, maxsplit=1)
     return parts[0].strip() if len(parts) >= 2 else (text or "").strip()
@@ -99,11 +249,11 @@ def make_section_context_map(questions: List[Dict[str, Any]]) -> Dict[str, str]:
         eid = q.get("entry_id")
         if not t:
             continue
-        if RE_SECTION.match(t):
+        if _is_section(t):
             current = extract_section_intro(t) or t
-            if eid and RE_SUBPART.search(t):
+            if eid and _is_subpart(t):
                 ctx_map[str(eid)] = current
             continue
-        if RE_SUBPART.match(t) and current and eid:
+        if current and eid and _is_subpart(t):
             ctx_map[str(eid)] = current
     return ctx_map